@@ -1,15 +1,53 @@
+import asyncio
+import gzip
+import io
+import logging
+import logging.handlers
 import os
+import sys
 import time
 from datetime import datetime, timedelta, timezone
 
 
-import pandas as pd
-from sqlalchemy import create_engine, text
-from supabase import create_client
+import httpx
+import orjson
+from adbc_driver_postgresql import dbapi as adbc
+from sqlalchemy import create_engine, make_url, text
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_any,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# =========================
+# LOGGING
+# =========================
+
+# buffer log records and flush in bulk (or right away on errors) instead of
+# a blocking stdout write per message
+stream_handler = logging.StreamHandler(sys.stdout)
+stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[
+        logging.handlers.MemoryHandler(
+            capacity=200,
+            flushLevel=logging.ERROR,
+            target=stream_handler
+        )
+    ]
+)
+logger = logging.getLogger("sync_jobs")
+
+# httpx logs every request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
 # =========================
 # CONFIG (NEW)
 # =========================
@@ -18,7 +56,29 @@ WINDOW_SIZE = timedelta(days=1)   # ✅ process 1 day per run
 MAX_RUNTIME_SECONDS = 540         # ✅ 9 mins max (safe for 10 min cron)
 
 CHUNK_SIZE = 2000                # ✅ reduced for speed
-SUPABASE_BATCH = 200             # ✅ reduced for speed
+# ✅ tune per workload: batch size and concurrency interact, compare the
+# rows/s in the per-batch log lines when changing either
+SUPABASE_BATCH = max(1, int(os.environ.get("SUPABASE_BATCH_SIZE", 200)))
+MAX_CONCURRENCY = max(1, int(os.environ.get("SUPABASE_CONCURRENCY", 8)))
+QUEUE_SIZE = MAX_CONCURRENCY * 2 # ✅ backpressure between fetch and upload
+
+COUNTRY = "United States of America"  # ✅ constant for every synced row
+
+# ✅ gzip level for upsert bodies (0 = off); needs a gateway that accepts Content-Encoding
+GZIP_LEVEL = min(9, max(0, int(os.environ.get("SUPABASE_GZIP_LEVEL", 0))))
+
+# ✅ warm pool that survives idle disconnects, sized so every COPY consumer
+# gets its own connection (+ headroom for the watermark read),
+# plus psycopg2's batched executemany (INSERT .. VALUES pages + execute_batch)
+ENGINE_OPTIONS = {
+    "pool_size": MAX_CONCURRENCY,
+    "max_overflow": 2,
+    "pool_pre_ping": True,
+    "pool_recycle": 300,
+    "executemany_mode": "values_plus_batch",
+    "insertmanyvalues_page_size": 1000,
+    "executemany_batch_page_size": 500,
+}
 
 start_execution = time.time()
 
@@ -31,16 +91,15 @@ try:
     if not conn_str:
         raise ValueError("PSQL_KEY environment variable is missing")
 
-    engine = create_engine(
-        conn_str,
-        pool_pre_ping=True,
-        pool_recycle=300
+    # ADBC reads straight into Arrow buffers and wants a plain libpq URI
+    source_uri = make_url(conn_str).set(drivername="postgresql").render_as_string(
+        hide_password=False
     )
 
-    print("Successfully connected to PostgreSQL!")
+    logger.info("Successfully connected to PostgreSQL!")
 
 except Exception as e:
-    print(f"PostgreSQL connection error: {e}")
+    logger.error("PostgreSQL connection error: %s", e)
     exit()
 
 
@@ -51,12 +110,39 @@ try:
     if not url or not key:
         raise ValueError("SUPABASE_URL or SUPABASE_KEY missing")
 
-    supabase = create_client(url, key)
+    # plain PostgREST over httpx, no supabase-py client in the hot path
+    rest_url = f"{url.rstrip('/')}/rest/v1/job_jobrole_all"
+    auth_headers = {
+        "apikey": key,
+        "Authorization": f"Bearer {key}",
+    }
+
+    upsert_url = f"{rest_url}?on_conflict=job_id"
+    upsert_headers = {
+        **auth_headers,
+        "Content-Type": "application/json",
+        "Prefer": "resolution=merge-duplicates,return=minimal",
+    }
+
+    logger.info("Supabase REST endpoint configured")
+
+    # Optional direct Postgres connection behind Supabase → bulk COPY instead of REST
+    supabase_db_url = os.environ.get("SUPABASE_DB_URL")
+    supabase_engine = None
 
-    print("Successfully connected to Supabase!")
+    if supabase_db_url:
+        # point SUPABASE_DB_URL at the Supabase pooler to avoid max_client_conn exhaustion
+        supabase_db = make_url(supabase_db_url)
+
+        # ✅ require TLS by default, but never override a stricter sslmode from the URL
+        if "sslmode" not in supabase_db.query:
+            supabase_db = supabase_db.update_query_dict({"sslmode": "require"})
+
+        supabase_engine = create_engine(supabase_db, **ENGINE_OPTIONS)
+        logger.info("Using direct Supabase Postgres connection for COPY")
 
 except Exception as e:
-    print(f"Supabase connection error: {e}")
+    logger.error("Supabase connection error: %s", e)
     exit()
 
 
@@ -64,34 +150,60 @@ except Exception as e:
 # FETCH MAX UPLOAD DATE
 # =========================
 
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def fetch_max_upload_date():
+    # direct connection skips the PostgREST round-trip when it's configured
+    if supabase_engine is not None:
+        with supabase_engine.connect() as conn:
+            return conn.execute(
+                text("SELECT max(upload_date) FROM job_jobrole_all")
+            ).scalar()
+
+    response = httpx.get(
+        rest_url,
+        params={
+            "select": "upload_date",
+            "upload_date": "not.is.null",
+            "order": "upload_date.desc",
+            "limit": 1,
+        },
+        headers=auth_headers,
+        timeout=60
+    )
+    response.raise_for_status()
+
+    rows = response.json()
+    if not rows:
+        return None
+
+    return rows[0]["upload_date"]
+
+
 def get_max_upload_date():
     try:
-        response = (
-            supabase.table("job_jobrole_all")
-            .select("upload_date")
-            .not_.is_("upload_date", None)
-            .order("upload_date", desc=True)
-            .limit(1)
-            .execute()
-        )
-
-        if not response.data:
-            print("No existing records found → full sync")
-            return datetime(1970, 1, 1)
+        raw_date = fetch_max_upload_date()
 
-        raw_date = response.data[0]["upload_date"]
+        if raw_date is None:
+            logger.info("No existing records found → full sync")
+            return EPOCH
 
         if isinstance(raw_date, str):
             dt = datetime.fromisoformat(raw_date.replace("Z", "+00:00"))
         else:
             dt = raw_date
 
-        print(f"Max upload date: {dt}")
+        # ✅ keep comparisons with `now` timezone-aware
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+
+        logger.info("Max upload date: %s", dt)
         return dt
 
     except Exception as e:
-        print(f"Error fetching max upload date: {e}")
-        return datetime(1970, 1, 1)
+        logger.error("Error fetching max upload date: %s", e)
+        return EPOCH
 
 last_time = get_max_upload_date()
 
@@ -102,25 +214,44 @@ start_time = last_time + WINDOW_SIZE
 
 
 # ✅ prevent future overflow
-from datetime import timezone
 now = datetime.now(timezone.utc)
 
 end_time = min(start_time + WINDOW_SIZE, now)
 
 
-print("=" * 80)
-print(f"Processing window: {start_time} → {end_time}")
-print("=" * 80)
+logger.info("Processing window: %s → %s", start_time, end_time)
 
 # =========================
 # SQL QUERY (UPDATED)
 # =========================
 
+# ✅ read from the precomputed karmafy_job_with_role materialized view (see README)
+USE_SOURCE_VIEW = os.environ.get("USE_SOURCE_VIEW", "").lower() in ("1", "true", "yes")
+
+if USE_SOURCE_VIEW:
+    role_columns = """
+    j.job_role_id,
+    j.job_role_name,"""
+    source_relation = """
+FROM "karmafy_job_with_role" j"""
+else:
+    role_columns = """
+    jr.id AS job_role_id,
+    jr.name AS job_role_name,"""
+    source_relation = """
+FROM "karmafy_job" j
+LEFT JOIN "karmafy_jobrole" jr
+    ON j."roleId"::bigint = jr.id"""
+
+def sql_timestamp(value):
+    # ADBC only streams (COPY) parameter-free queries; with bound parameters it
+    # buffers the whole result, so the window bounds go in as escaped literals
+    return "'{}'::timestamptz".format(value.isoformat().replace("'", "''"))
+
+
 sql_query = f"""
 SELECT
-    j.id AS job_id,
-    jr.id AS job_role_id,
-    jr.name AS job_role_name,
+    j.id AS job_id,{role_columns}
     j.source,
     j.title,
     j.company,
@@ -129,18 +260,15 @@ SELECT
     j.description,
     j."applyType" AS apply_type,
     j."rawText" AS raw_text,
-    j."datePosted" AS date_posted,
+    to_char(j."datePosted", 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"') AS date_posted,
     j."hoursBackPosted" AS hours_back_posted,
     j."yearsExpRequired" AS years_exp_required,
-    j."uploadDate" AS upload_date,
-    j."ingestedAt" AS ingested_at
-
-FROM "karmafy_job" j
-LEFT JOIN "karmafy_jobrole" jr
-    ON j."roleId"::bigint = jr.id
+    to_char(j."uploadDate", 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"') AS upload_date,
+    to_char(j."ingestedAt", 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"') AS ingested_at
+{source_relation}
 
-WHERE j."uploadDate" >= '{start_time}'
-AND j."uploadDate" < '{end_time}'
+WHERE j."uploadDate" >= {sql_timestamp(start_time)}
+AND j."uploadDate" < {sql_timestamp(end_time)}
 
 
 ORDER BY j."uploadDate" ASC
@@ -151,96 +279,314 @@ ORDER BY j."uploadDate" ASC
 # HELPERS
 # =========================
 
-def clean_value(v):
-    if pd.isna(v):
-        return None
-    return v
-
-
-def prepare_record(row):
-    return {
-        "job_id": int(row["job_id"]) if pd.notna(row["job_id"]) else None,
-        "job_role_id": int(row["job_role_id"]) if pd.notna(row["job_role_id"]) else None,
-        "job_role_name": clean_value(row["job_role_name"]),
-        "source": clean_value(row["source"]) or "",
-        "title": clean_value(row["title"]) or "",
-        "company": clean_value(row["company"]) or "",
-        "location": clean_value(row["location"]) or "",
-        "url": clean_value(row["url"]) or "",
-        "description": clean_value(row["description"]) or "",
-        "apply_type": clean_value(row["apply_type"]),
-        "raw_text": clean_value(row["raw_text"]) or "",
-        "date_posted": row["date_posted"].isoformat() if pd.notna(row["date_posted"]) else None,
-        "hours_back_posted": int(row["hours_back_posted"]) if pd.notna(row["hours_back_posted"]) else 0,
-        "years_exp_required": clean_value(row["years_exp_required"]),
-        "upload_date": row["upload_date"].isoformat() if pd.notna(row["upload_date"]) else None,
-        "ingested_at": row["ingested_at"].isoformat() if pd.notna(row["ingested_at"]) else None,
-        "country": "United States of America"
-    }
+def deadline_reached():
+    return time.time() - start_execution > MAX_RUNTIME_SECONDS
+
+
+def read_chunks():
+    # Arrow record batches come off the wire columnar; only CHUNK_SIZE rows
+    # at a time are converted into a pandas DataFrame
+    with adbc.connect(source_uri) as conn:
+        with conn.cursor() as cur:
+            # to_char in the query labels every timestamp with "Z". A UTC session makes
+            # that true for timestamptz columns; naive (timestamp without time zone)
+            # source columns are assumed to already hold UTC, which the session
+            # timezone doesn't change
+            cur.execute("SET TIME ZONE 'UTC'")
+            cur.execute(sql_query)
+
+            for batch in cur.fetch_record_batch():
+                for offset in range(0, batch.num_rows, CHUNK_SIZE):
+                    yield batch.slice(offset, CHUNK_SIZE).to_pandas()
+
+
+INT_COLUMNS = ["job_id", "job_role_id"]
+TEXT_COLUMNS = ["source", "title", "company", "location", "url", "description", "raw_text"]
+
+
+def prepare_frame(df):
+    for col in INT_COLUMNS:
+        df[col] = df[col].astype("Int64")
+
+    df["hours_back_posted"] = df["hours_back_posted"].fillna(0).astype("int64")
+
+    for col in TEXT_COLUMNS:
+        df[col] = df[col].fillna("")
+
+    # one pass over the whole frame: NaN / NaT / <NA> → None
+    df = df.astype(object).where(df.notna(), None)
+
+    return df.assign(country=COUNTRY)
+
+
+def prepare_records(df):
+    return prepare_frame(df).to_dict(orient="records")
+
+
+# =========================
+# UPSERT
+# =========================
+
+def is_row_error(response):
+    # only Postgres data exceptions (22xxx) and integrity violations (23xxx) point
+    # at the rows themselves; PGRSTxxx, 42703, 42P10, 401/403/404, ... mean the
+    # request or the setup is wrong and no single row can be blamed
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+
+    code = str(body.get("code", "")) if isinstance(body, dict) else ""
+    return code[:2] in ("22", "23")
+
+
+def is_transient(error):
+    # rate limits, 5xx and network errors are worth retrying
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+@retry(
+    stop=stop_any(stop_after_attempt(5), lambda retry_state: deadline_reached()),
+    wait=wait_exponential_jitter(initial=0.5, max=30),
+    retry=retry_if_exception(is_transient),
+    reraise=True
+)
+async def upsert_batch(client, batch):
+    # orjson handles numpy scalars natively, no per-value int() coercion needed
+    body = orjson.dumps(batch, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+    headers = upsert_headers
+
+    if GZIP_LEVEL:
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        headers = {**upsert_headers, "Content-Encoding": "gzip"}
+
+    response = await client.post(upsert_url, content=body, headers=headers)
+    response.raise_for_status()
+    return len(batch)
+
+
+async def upsert_with_fallback(client, batch, stop):
+    # a batch rejected for its data is split in half until the offending row(s)
+    # are isolated; configuration errors abort the whole sync instead
+    if stop.is_set() or deadline_reached():
+        return 0, len(batch)
+
+    try:
+        return await upsert_batch(client, batch), 0
+
+    except httpx.TransportError as error:
+        logger.error("✗ %d rows failed after retries: %s", len(batch), error)
+        return 0, len(batch)
+
+    except httpx.HTTPStatusError as error:
+        status = error.response.status_code
+
+        # only this (sub-)batch is lost; sibling halves keep their counts
+        if is_transient(error):
+            logger.error("✗ %d rows failed after retries: HTTP %d", len(batch), status)
+            return 0, len(batch)
+
+        if not is_row_error(error.response):
+            if not stop.is_set():
+                logger.error("✗ Aborting sync on HTTP %d: %s", status, error.response.text)
+                stop.set()
+            return 0, len(batch)
+
+        if len(batch) == 1:
+            logger.error("✗ Skipping job_id %s: %s", batch[0]["job_id"], error.response.text)
+            return 0, 1
+
+        middle = len(batch) // 2
+        left_inserted, left_failed = await upsert_with_fallback(client, batch[:middle], stop)
+        right_inserted, right_failed = await upsert_with_fallback(client, batch[middle:], stop)
+        return left_inserted + right_inserted, left_failed + right_failed
+
+
+COPY_COLUMNS = [
+    "job_id", "job_role_id", "job_role_name", "source", "title", "company",
+    "location", "url", "description", "apply_type", "raw_text", "date_posted",
+    "hours_back_posted", "years_exp_required", "upload_date", "ingested_at",
+    "country",
+]
+
+
+def copy_upsert(df):
+    # COPY into a temp table, then merge so existing job_ids are still updated
+    columns = ", ".join(COPY_COLUMNS)
+    update_columns = [col for col in COPY_COLUMNS if col != "job_id"]
+    updates = ", ".join(f"{col} = EXCLUDED.{col}" for col in update_columns)
+
+    # only rewrite rows whose content actually changed
+    changed = "({}) IS DISTINCT FROM ({})".format(
+        ", ".join(f"job_jobrole_all.{col}" for col in update_columns),
+        ", ".join(f"EXCLUDED.{col}" for col in update_columns),
+    )
+
+    buf = io.StringIO()
+    # explicit NULL marker so None and "" stay distinct (same as the REST path)
+    df[COPY_COLUMNS].to_csv(buf, header=False, index=False, na_rep="\\N")
+    buf.seek(0)
+
+    conn = supabase_engine.raw_connection()
+    try:
+        with conn.cursor() as cur:
+            # only the loaded columns: no identity/serial id, NOT NULL or defaults to trip over
+            cur.execute(
+                "CREATE TEMP TABLE job_jobrole_all_stage ON COMMIT DROP AS "
+                f"SELECT {columns} FROM job_jobrole_all WITH NO DATA"
+            )
+            cur.copy_expert(
+                f"COPY job_jobrole_all_stage ({columns}) FROM STDIN "
+                "WITH (FORMAT CSV, NULL '\\N')",
+                buf
+            )
+            # DISTINCT ON keeps the newest copy of a job_id repeated within the chunk,
+            # which ON CONFLICT DO UPDATE would otherwise reject
+            cur.execute(
+                f"INSERT INTO job_jobrole_all ({columns}) "
+                f"SELECT DISTINCT ON (job_id) {columns} FROM job_jobrole_all_stage "
+                f"ORDER BY job_id, upload_date DESC "
+                f"ON CONFLICT (job_id) DO UPDATE SET {updates} "
+                f"WHERE {changed}"
+            )
+            inserted = cur.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    return inserted
 
 
 # =========================
 # CHUNKED PROCESSING
 # =========================
 
-total_inserted = 0
-total_errors = 0
+def prepare_chunk(chunks):
+    # runs in a worker thread so fetching + prep don't block the uploads
+    chunk_df = next(chunks, None)
 
-print("=" * 80)
-print("STARTING CHUNKED SYNC")
-print("=" * 80)
+    if chunk_df is None:
+        return None
 
-try:
-    for chunk_number, chunk_df in enumerate(
-        pd.read_sql(text(sql_query), engine, chunksize=CHUNK_SIZE),
-        start=1
-    ):
+    if supabase_engine is not None:
+        return prepare_frame(chunk_df)
+
+    return prepare_records(chunk_df)
 
-        print(f"\nProcessing chunk {chunk_number} → {len(chunk_df)} rows")
 
-        records = [prepare_record(row) for _, row in chunk_df.iterrows()]
+async def produce(queue, stop):
+    loop = asyncio.get_running_loop()
+    chunks = read_chunks()
+    chunk_number = 0
 
-        for i in range(0, len(records), SUPABASE_BATCH):
+    try:
+        while True:
 
             # ✅ STOP if runtime exceeds limit
-            if time.time() - start_execution > MAX_RUNTIME_SECONDS:
-                print("⏱️ Max runtime reached, stopping early")
+            if deadline_reached():
+                logger.warning("⏱️ Max runtime reached, stopping early")
                 raise Exception("Stopping early to avoid long cron execution")
 
-            batch = records[i:i + SUPABASE_BATCH]
+            if stop.is_set():
+                raise Exception("Upload aborted")
 
-            try:
-                response = (
-                    supabase.table("job_jobrole_all")
-                    .upsert(batch, on_conflict="job_id")
-                    .execute()
-                )
+            payload = await loop.run_in_executor(None, prepare_chunk, chunks)
+            if payload is None:
+                break
+
+            chunk_number += 1
+            logger.info("Processing chunk %d → %d rows", chunk_number, len(payload))
 
-                inserted = len(response.data) if response.data else 0
-                total_inserted += inserted
+            if supabase_engine is not None:
+                await queue.put((chunk_number, "COPY", payload))
+                continue
 
-                print(
-                    f"✓ Chunk {chunk_number} | Batch {i//SUPABASE_BATCH + 1} | Inserted {inserted}"
+            for i in range(0, len(payload), SUPABASE_BATCH):
+                await queue.put(
+                    (chunk_number, f"Batch {i//SUPABASE_BATCH + 1}", payload[i:i + SUPABASE_BATCH])
                 )
 
-                time.sleep(0.1)  # ✅ prevent rate limits
+    except Exception as e:
+        logger.warning("Stopped safely: %s", e)
+
+    finally:
+        chunks.close()
+        for _ in range(MAX_CONCURRENCY):
+            await queue.put(None)
+
+
+async def consume(queue, client, totals, stop):
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+
+        chunk_number, label, payload = item
+
+        # ✅ queued work past the runtime cap (or after an abort) is dropped, not uploaded
+        if deadline_reached() or stop.is_set():
+            totals["skipped"] += len(payload)
+            continue
+
+        started = time.perf_counter()
+
+        try:
+            if supabase_engine is not None:
+                inserted, failed = await asyncio.to_thread(copy_upsert, payload), 0
+            else:
+                inserted, failed = await upsert_with_fallback(client, payload, stop)
+
+            elapsed = time.perf_counter() - started
+            totals["inserted"] += inserted
+            totals["errors"] += failed
+            logger.info(
+                "✓ Chunk %d | %s | Inserted %d | %.0f ms | %.0f rows/s",
+                chunk_number, label, inserted, elapsed * 1000, len(payload) / elapsed
+            )
+
+        except Exception as upload_error:
+            totals["errors"] += len(payload)
+            logger.error("✗ Chunk %d | %s | Error: %s", chunk_number, label, upload_error)
+
+
+async def sync():
+    totals = {"inserted": 0, "errors": 0, "skipped": 0}
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    stop = asyncio.Event()
+
+    async with httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=MAX_CONCURRENCY),
+        http2=True,
+        timeout=60
+    ) as client:
+
+        await asyncio.gather(
+            produce(queue, stop),
+            *(consume(queue, client, totals, stop) for _ in range(MAX_CONCURRENCY))
+        )
+
+    if totals["skipped"]:
+        logger.warning("Stopped early, dropped %d queued rows", totals["skipped"])
 
-            except Exception as batch_error:
-                total_errors += len(batch)
-                print(
-                    f"✗ Chunk {chunk_number} | Batch {i//SUPABASE_BATCH + 1} | Error: {batch_error}"
-                )
+    return totals["inserted"], totals["errors"], totals["skipped"]
 
-except Exception as e:
-    print(f"Stopped safely: {e}")
+
+logger.info("STARTING CHUNKED SYNC")
+
+total_inserted, total_errors, total_skipped = asyncio.run(sync())
 
 
 # =========================
 # FINAL REPORT
 # =========================
 
-print("\n" + "=" * 80)
-print("SYNC COMPLETE")
-print("=" * 80)
-print(f"Inserted: {total_inserted}")
-print(f"Errors: {total_errors}")
+logger.info(
+    "SYNC COMPLETE → Inserted: %d | Errors: %d | Skipped: %d",
+    total_inserted, total_errors, total_skipped
+)